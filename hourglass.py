@@ -15,16 +15,38 @@
 ## ---------------------------
 
 
+import os
 import time
+import queue
+import atexit
 import json
 import socket
+import struct
+import heapq
 import random
+import signal
+import threading
 import subprocess
+from dataclasses import dataclass
+from functools import lru_cache
+from bisect import bisect_left, bisect_right
+from itertools import count, product
+from operator import itemgetter
 from pathlib import Path
 from datetime import datetime, timedelta
-from collections import deque
+from collections import OrderedDict, deque
 import logging, coloredlogs
 
+try:
+    from pymediainfo import MediaInfo
+except ImportError:
+    MediaInfo = None
+
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    json_loads = json.loads  # also accepts bytes
+
 
 EXEC_DIR = Path(__file__).resolve().parent
 log = logging.getLogger("hourglass")
@@ -33,28 +55,57 @@ coloredlogs.install(level="DEBUG", logger=log)
 
 PLAYER_SLEEP = 1
 VIDEO_EXTENSIONS = {".mp4", ".mkv", ".mov", ".ts", ".avi"}
+# Every upper/lower case spelling, for str.endswith in directory scans; no
+# per-file suffix split or .lower() allocation.
+VIDEO_SUFFIXES = tuple(
+    "".join(chars)
+    for ext in sorted(VIDEO_EXTENSIONS)
+    for chars in product(*({c.lower(), c.upper()} for c in ext))
+)
 QUEUE_MAX_SIZE = 5
+FIT_CHOICES = 3  # pick randomly among this many best fits to keep variety
+FIT_TOLERANCE = 30  # seconds of gap treated as a good enough fit
+PREFETCH_FOLDERS = 3  # show folders probed in the background per play
+PROBE_WORKERS = 8  # probes wait on I/O and process spawn, so not tied to CPUs
+
+EXCLUDED_NAMES = frozenset()  # file names never queued as episodes
+
+
+@dataclass(slots=True)
+class ClipItem:
+    path: str
+    type: str
+    label: str
+    duration: float
+
 
 recent_fillers = deque(maxlen=5)
-play_queue = []
+recent_fillers_set = set()  # mirrors recent_fillers for O(1) membership tests
+play_queue = deque()
 
 current_show_index = 0
 episodes_played_from_show = 0
 
 
 def normalize_path(path):
+    # Keyed on the string form so Path and str callers share cache entries.
+    return _normalize_path(str(path))
+
+
+@lru_cache(maxsize=4096)
+def _normalize_path(path):
+    # abspath is pure string work; resolve() would stat every path component,
+    # which is slow on network mounts and not needed for CasparCG.
     try:
-        if isinstance(path, str):
-            path = Path(path)
-        return str(path.resolve()).replace("\\", "/")
+        return os.path.abspath(path).replace("\\", "/")
     except Exception as e:
         log.error(f"Failed to normalize path: {e}")
-        return str(path)
+        return path
 
 
 try:
-    with open(f"{EXEC_DIR}\config.json", "r") as conf_file:
-        conf = json.load(conf_file)
+    with open(EXEC_DIR / "config.json", "rb") as conf_file:
+        conf = json_loads(conf_file.read())
     SLOT_MINUTE = conf["SLOT_MINUTE"]
     SLOT_DURATION = conf["SLOT_DURATION"]
     COMMERCIAL_PADDING = conf["COMMERCIAL_PADDING"]
@@ -63,46 +114,150 @@ try:
     SLOT_FOLDER = Path(conf["SLOT_FOLDER"])
     CASPAR_HOST = conf["CASPAR_HOST"]
     CASPAR_PORT = conf["CASPAR_PORT"]
+    CASPAR_OSC_PORT = conf.get("CASPAR_OSC_PORT", 6250)
     EPISODES_PER_SHOW = conf["EPISODES_PER_SHOW"]
 except:
     log.error("Cant load config.")
     exit()
 
 
+DIR_CACHE_TTL = 300
+_dir_cache = {}
+
+
+def _cached_scan(folder, scan):
+    # Listings are reused until the folder's mtime changes, which saves a
+    # directory scan per call on network-mounted media. The TTL also catches
+    # mounts that don't update directory mtimes reliably.
+    mtime = folder.stat().st_mtime_ns
+    now = time.monotonic()
+    cached = _dir_cache.get((folder, scan))
+    if cached and cached[0] == mtime and now - cached[1] < DIR_CACHE_TTL:
+        return cached[2]
+    entries = scan(folder)
+    # Hand back the cached tuple when nothing changed, so indexes keyed on
+    # the listing's identity are not rebuilt on every TTL expiry.
+    if cached and cached[2] == entries:
+        entries = cached[2]
+    _dir_cache[(folder, scan)] = (mtime, now, entries)
+    return entries
+
+
+def _scan_videos(folder):
+    # DirEntry.is_file() answers from the directory read, without a stat()
+    with os.scandir(folder) as entries:
+        return tuple(
+            Path(e.path)
+            for e in entries
+            if e.name.endswith(VIDEO_SUFFIXES) and e.is_file()
+        )
+
+
+def _scan_subdirs(folder):
+    with os.scandir(folder) as entries:
+        return tuple(Path(e.path) for e in entries if e.is_dir())
+
+
+def list_videos(folder):
+    return _cached_scan(folder, _scan_videos)
+
+
+def list_subdirs(folder):
+    return _cached_scan(folder, _scan_subdirs)
+
+
 def get_show_folders():
     try:
-        return [f for f in EPISODES_FOLDER.iterdir() if f.is_dir()]
+        return list(list_subdirs(EPISODES_FOLDER))
     except Exception as e:
         log.error(f"Failed to list show folders: {e}")
         return []
 
 
-show_folders = get_show_folders()
-
-
 class CasparCGClient:
     def __init__(self, host=CASPAR_HOST, port=CASPAR_PORT):
         self.host = host
         self.port = port
+        self._sock = None
+        self._file = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        sock = socket.create_connection((self.host, self.port), timeout=2)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        # The link sits idle for a whole episode between commands; keepalive
+        # lets the OS notice a dead server instead of the next PLAY timing out.
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        self._sock = sock
+        self._file = sock.makefile("rwb")
+
+    def _disconnect(self):
+        for conn in (self._file, self._sock):
+            try:
+                if conn:
+                    conn.close()
+            except OSError:
+                pass
+        self._sock = None
+        self._file = None
+
+    def _read_reply(self):
+        # AMCP replies are one status line; 201 adds a single data line and
+        # 200 adds data lines terminated by an empty line.
+        line = self._file.readline()
+        if not line:
+            raise ConnectionResetError("CasparCG closed the connection")
+        reply = [line.decode().strip()]
+        if reply[0].startswith("201"):
+            reply.append(self._file.readline().decode().strip())
+        elif reply[0].startswith("200"):
+            while True:
+                line = self._file.readline()
+                if not line.strip():
+                    break
+                reply.append(line.decode().strip())
+        return "\n".join(reply)
+
+    def _exchange(self, payload):
+        if self._sock is None:
+            self._connect()
+        self._file.write(payload)
+        self._file.flush()
+        return self._read_reply()
+
+    def close(self):
+        with self._lock:
+            self._disconnect()
+
+    def send_raw(self, payload):
+        """Send an already encoded, CRLF-terminated AMCP command."""
+        with self._lock:
+            try:
+                try:
+                    return self._exchange(payload)
+                except (BrokenPipeError, ConnectionResetError):
+                    # The server may have dropped an idle connection; retry once.
+                    self._disconnect()
+                    return self._exchange(payload)
+            except Exception as e:
+                self._disconnect()
+                cmd = payload.decode(errors="replace").strip()
+                log.error(f"Failed to send command '{cmd}': {e}")
+                return None
 
     def send_command(self, cmd):
-        try:
-            with socket.create_connection((self.host, self.port), timeout=2) as sock:
-                sock.sendall((cmd + "\r\n").encode())
-                return sock.recv(1024).decode().strip()
-        except Exception as e:
-            log.error(f"Failed to send command '{cmd}': {e}")
-            return None
+        return self.send_raw((cmd + "\r\n").encode())
 
     def play_video(
         self, path, channel=1, layer=10, audio_channels=None, audio_map=None
     ):
-        cmd = f'PLAY {channel}-{layer} "{normalize_path(path)}"'
+        # Built as bytes so only the path needs encoding on the play path.
+        payload = b'PLAY %d-%d "%s"' % (channel, layer, normalize_path(path).encode())
         if audio_channels:
-            cmd += f" --audioChannels {audio_channels}"
+            payload += b" --audioChannels " + str(audio_channels).encode()
         if audio_map:
-            cmd += f" --audioMap {audio_map}"
-        return self.send_command(cmd)
+            payload += b" --audioMap " + str(audio_map).encode()
+        return self.send_raw(payload + b"\r\n")
 
     def overlay_caption(self, text, channel=1, layer=20, template="timestamp_template"):
         json_data = f'{{"text":"{text}"}}'
@@ -111,9 +266,125 @@ class CasparCGClient:
         )
 
 
+def _osc_string(data, i):
+    end = data.index(b"\0", i)
+    return data[i:end].decode(errors="replace"), (end + 4) & ~3
+
+
+def parse_osc(data):
+    """Yield (address, args) for every OSC message in a packet or bundle."""
+    if data.startswith(b"#bundle\0"):
+        i = 16  # skip the bundle header and time tag
+        while i + 4 <= len(data):
+            (size,) = struct.unpack_from(">i", data, i)
+            yield from parse_osc(data[i + 4 : i + 4 + size])
+            i += 4 + size
+        return
+
+    address, i = _osc_string(data, 0)
+    tags, i = _osc_string(data, i)
+    args = []
+    for tag in tags[1:]:
+        if tag in "if":
+            args.append(struct.unpack_from(">" + tag, data, i)[0])
+            i += 4
+        elif tag in "hd":
+            args.append(struct.unpack_from(">q" if tag == "h" else ">d", data, i)[0])
+            i += 8
+        elif tag == "s":
+            value, i = _osc_string(data, i)
+            args.append(value)
+        elif tag in "TF":
+            args.append(tag == "T")
+        else:
+            break  # blobs and other types are never needed here
+    yield address, args
+
+
+# Set when the current clip ends or an operator asks the scheduler to
+# re-evaluate (SIGUSR1); every scheduler wait returns early when it is set.
+wake = threading.Event()
+
+
+def sleep_until_woken(seconds):
+    woken = wake.wait(timeout=max(0, seconds))
+    wake.clear()
+    return woken
+
+
+class PlaybackMonitor:
+    """Watches CasparCG's OSC frame counter to tell when a clip has ended."""
+
+    def __init__(self, port=CASPAR_OSC_PORT, channel=1, layer=10):
+        self.port = port
+        prefix = f"/channel/{channel}/stage/layer/{layer}"
+        # 2.0.x reports file/frame; 2.1 and later nest it under foreground/
+        self.addresses = {f"{prefix}/file/frame", f"{prefix}/foreground/file/frame"}
+        self.done = wake
+        self._armed = False
+        self._last_seen = 0
+
+    def start(self):
+        try:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.bind(("", self.port))
+        except OSError as e:
+            log.error(f"OSC listener unavailable, using timed waits: {e}")
+            return
+        threading.Thread(target=self._listen, args=(sock,), daemon=True).start()
+
+    def is_alive(self):
+        # CasparCG sends OSC every frame, so a few seconds of silence means
+        # it is not configured to send to us.
+        return time.monotonic() - self._last_seen < 5
+
+    def arm(self):
+        # Called before PLAY. The previous clip may still report its last
+        # frame, so an end is only accepted once playback is seen in progress.
+        self._armed = False
+        self.done.clear()
+
+    def wait(self, duration, early=0):
+        if self.is_alive():
+            sleep_until_woken(duration + 5)
+        else:
+            sleep_until_woken(duration - early)
+
+    def _listen(self, sock):
+        while True:
+            try:
+                data = sock.recv(65535)
+                self._last_seen = time.monotonic()
+                for address, args in parse_osc(data):
+                    if address in self.addresses and len(args) >= 2:
+                        self._on_frame(args[0], args[1])
+            except Exception as e:
+                log.error(f"Failed to read OSC packet: {e}")
+
+    def _on_frame(self, current, total):
+        if total <= 0:
+            return
+        if current < total - 1:
+            self._armed = True
+        elif self._armed:
+            # The last frame keeps being reported until the next PLAY; fire
+            # once so later packets don't cut the scheduler's back-off short.
+            self._armed = False
+            self.done.set()
+
+
+def _scan_slot_clips(folder):
+    with os.scandir(folder) as entries:
+        return tuple(
+            Path(e.path)
+            for e in entries
+            if e.name.lower().endswith(".ts") and e.is_file()
+        )
+
+
 def get_random_slot_ts():
     try:
-        slot_files = sorted(SLOT_FOLDER.glob("*.ts"))
+        slot_files = _cached_scan(SLOT_FOLDER, _scan_slot_clips)
         if not slot_files:
             raise FileNotFoundError("No .ts files found in slot folder.")
         return random.choice(slot_files)
@@ -134,69 +405,314 @@ def time_until_next_slot():
         return SLOT_DURATION
 
 
-duration_cache = {}
+DURATION_CACHE_FILE = EXEC_DIR / "duration_cache.json"
+DURATION_CACHE_SAVE_INTERVAL = 30
+DURATION_CACHE_SAVE_EVERY = 50  # new probes; bounds what a kill -9 can lose
+DURATION_CACHE_MAX_ENTRIES = 10000  # floor; grown to fit the library
 
 
-def get_video_duration(file_path):
-    # print(f"[DEBUG] Probing duration for: {file_path}")
-    file_path = str(file_path)
-    if file_path in duration_cache:
-        return duration_cache[file_path]
+def load_duration_cache():
+    try:
+        with open(DURATION_CACHE_FILE, "r") as cache_file:
+            return json.load(cache_file)
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        log.error(f"Failed to load duration cache: {e}")
+        return {}
+
+
+# Least recently used first; trimmed to duration_cache_limit so months of
+# rotating media don't grow it without bound. The file holds at most what the
+# previous run kept, so it is loaded whole and trimmed as new probes come in.
+duration_cache = OrderedDict(load_duration_cache())
+duration_cache_limit = DURATION_CACHE_MAX_ENTRIES
+duration_cache_lock = threading.Lock()
+duration_cache_saved_at = time.monotonic()
+duration_cache_unsaved = 0
+
+
+def save_duration_cache():
+    global duration_cache_saved_at, duration_cache_unsaved
+    with duration_cache_lock:
+        duration_cache_saved_at = time.monotonic()
+        duration_cache_unsaved = 0
+        # Failed probes stay in memory only so they are retried next run.
+        entries = {k: v for k, v in duration_cache.items() if v > 0}
+        try:
+            # Write then rename, so a crash mid-save never leaves a torn file.
+            tmp_file = DURATION_CACHE_FILE.with_suffix(".json.tmp")
+            with open(tmp_file, "w") as cache_file:
+                json.dump(entries, cache_file)
+            os.replace(tmp_file, DURATION_CACHE_FILE)
+        except Exception as e:
+            log.error(f"Failed to save duration cache: {e}")
+
+
+atexit.register(save_duration_cache)
+
+
+def reserve_duration_cache(file_count):
+    # A cap below the library size evicts files that are still listed, which
+    # then get re-probed forever; keep room for twice what is on disk.
+    global duration_cache_limit
+    with duration_cache_lock:
+        duration_cache_limit = max(duration_cache_limit, 2 * file_count)
 
+
+def duration_cache_key(file_path):
+    # mtime and size change whenever a file is replaced or edited, which
+    # invalidates its entry without having to re-probe everything.
+    st = os.stat(file_path)
+    return f"{file_path}|{st.st_mtime_ns}|{st.st_size}"
+
+
+def _probe_mediainfo(file_path):
+    # Reads only the container header in-process; no ffprobe spawn.
+    if MediaInfo is None:
+        return 0
     try:
-        result = subprocess.run(
-            [
-                "ffprobe",
-                "-v",
-                "error",
-                "-show_entries",
-                "format=duration",
-                "-of",
-                "json",
-                file_path,
-            ],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            timeout=5,
-        )
-        data = json.loads(result.stdout)
-        duration = float(data["format"]["duration"])
-        duration_cache[file_path] = duration
+        # parse_speed=0 stops after the headers. full must stay on: without
+        # it Duration is only the human-readable "1mn 1s" form.
+        info = MediaInfo.parse(file_path, parse_speed=0)
+        general = info.general_tracks
+        if general and general[0].duration:
+            return float(general[0].duration) / 1000.0
+    except Exception as e:
+        log.debug(f"MediaInfo could not parse '{file_path}': {e}")
+    return 0
+
+
+# Read only the container header on the first pass; most files carry their
+# duration there and the default 5 MB probe dominates wallclock on big .ts files.
+FFPROBE_FAST_ARGS = ["-probesize", "65536", "-analyzeduration", "0"]
+
+
+def _run_ffprobe(file_path, probe_args=()):
+    result = subprocess.run(
+        [
+            "ffprobe",
+            "-v",
+            "error",
+            *probe_args,
+            "-select_streams",
+            "v:0",
+            "-show_entries",
+            "format=duration:stream=duration",
+            "-of",
+            "json",
+            file_path,
+        ],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        timeout=5,
+    )
+    data = json_loads(result.stdout)
+    duration = data.get("format", {}).get("duration")
+    if duration is None:
+        # Some muxers leave the container duration unset but tag the stream.
+        streams = data.get("streams") or [{}]
+        duration = streams[0].get("duration")
+    return float(duration)
+
+
+def _probe_ffprobe(file_path):
+    try:
+        return _run_ffprobe(file_path, FFPROBE_FAST_ARGS)
+    except Exception:
+        pass
+
+    try:
+        duration = _run_ffprobe(file_path)
+        log.warn(f"'{file_path}' needed a full probe; consider remuxing it")
         return duration
     except Exception as e:
         log.error(f"Could not get duration for '{file_path}': {e}")
-        duration_cache[file_path] = 0
         return 0
 
 
+def _probe_one(file_path):
+    return _probe_mediainfo(file_path) or _probe_ffprobe(file_path)
+
+
+def get_video_duration(file_path):
+    # print(f"[DEBUG] Probing duration for: {file_path}")
+    global duration_cache_unsaved
+    file_path = str(file_path)
+    try:
+        key = duration_cache_key(file_path)
+    except OSError as e:
+        log.error(f"Could not stat '{file_path}': {e}")
+        return 0
+
+    with duration_cache_lock:
+        if key in duration_cache:
+            duration_cache.move_to_end(key)
+            return duration_cache[key]
+
+    duration = _probe_one(file_path)
+    evicted = []
+    with duration_cache_lock:
+        duration_cache[key] = duration
+        while len(duration_cache) > duration_cache_limit:
+            evicted.append(duration_cache.popitem(last=False)[0])
+        duration_cache_unsaved += 1
+        save_due = (
+            duration_cache_unsaved >= DURATION_CACHE_SAVE_EVERY
+            or time.monotonic() - duration_cache_saved_at
+            >= DURATION_CACHE_SAVE_INTERVAL
+        )
+    for old_key in evicted:
+        old_path = old_key.rsplit("|", 2)[0]
+        try:
+            still_listed = duration_cache_key(old_path) == old_key
+        except OSError:
+            still_listed = False
+        if still_listed:
+            log.warn(f"Duration cache is full, evicted current file '{old_path}'")
+    if save_due:
+        save_duration_cache()
+    return duration
+
+
+# Urgent probes (something is waiting on the result) are taken ahead of
+# warm-up and prefetch work; the counter keeps FIFO order within a priority.
+PROBE_URGENT, PROBE_BACKGROUND = 0, 1
+probe_queue = queue.PriorityQueue()
+probe_order = count()
+probe_pending = {}  # path -> Event set once its probe has finished
+probe_queued = {}  # path -> priority, for probes not picked up by a worker yet
+probe_pending_lock = threading.Lock()
+
+
+def _probe_worker():
+    while True:
+        _, _, file_path = probe_queue.get()
+        with probe_pending_lock:
+            # A promoted probe leaves its older, lower-priority entry behind
+            if probe_queued.pop(file_path, None) is None:
+                continue
+        try:
+            get_video_duration(file_path)
+        except Exception as e:
+            log.error(f"Background probe failed for '{file_path}': {e}")
+        finally:
+            with probe_pending_lock:
+                probe_pending.pop(file_path).set()
+
+
+def start_probe_workers(count=PROBE_WORKERS):
+    # ffprobe is process-spawn and I/O bound, not CPU bound, so threads
+    # give near-linear speedup until the disk saturates.
+    for _ in range(count):
+        threading.Thread(target=_probe_worker, daemon=True).start()
+
+
+def enqueue_probe(file_path, urgent=False):
+    # Returns an Event to wait on; a file already queued or in flight shares
+    # the existing probe instead of being run twice. An urgent request for a
+    # file still waiting in the queue moves it to the front.
+    file_path = str(file_path)
+    priority = PROBE_URGENT if urgent else PROBE_BACKGROUND
+    with probe_pending_lock:
+        done = probe_pending.get(file_path)
+        if done is not None and probe_queued.get(file_path, priority) <= priority:
+            return done
+        if done is None:
+            done = probe_pending[file_path] = threading.Event()
+        probe_queued[file_path] = priority
+        probe_queue.put((priority, next(probe_order), file_path))
+    return done
+
+
+def cached_duration(file_path, urgent=False):
+    """Return the cached duration, or None after queueing a background probe."""
+    try:
+        key = duration_cache_key(str(file_path))
+    except OSError:
+        return 0
+    with duration_cache_lock:
+        if key in duration_cache:
+            duration_cache.move_to_end(key)
+            return duration_cache[key]
+    enqueue_probe(file_path, urgent)
+    return None
+
+
+def get_video_durations_bulk(paths):
+    """Probe several files in parallel; durations come back in input order."""
+    misses = [
+        enqueue_probe(path, urgent=True)
+        for path in paths
+        if cached_duration(path, urgent=True) is None
+    ]
+    for done in misses:
+        done.wait()
+    return [get_video_duration(path) for path in paths]
+
+
+def warm_duration_cache(paths):
+    # Queues every cache miss for the probe workers without waiting on them.
+    # Returns the number of files queued.
+    reserve_duration_cache(len(paths))
+    return sum(cached_duration(path) is None for path in paths)
+
+
+def get_all_videos():
+    videos = []
+    for folder in get_show_folders() + [FILLER_FOLDER]:
+        try:
+            videos.extend(list_videos(folder))
+        except Exception as e:
+            log.error(f"Failed to list videos in '{folder}': {e}")
+    return videos
+
+
+def prefetch_durations(folder_count=PREFETCH_FOLDERS):
+    # Runs while a clip plays, so the next refill_queue/get_fitting_episode
+    # finds new files already probed instead of stalling on them.
+    show_folders = get_show_folders()
+    for folder in random.sample(show_folders, min(folder_count, len(show_folders))):
+        try:
+            for video in list_videos(folder):
+                cached_duration(video)  # queues only the misses
+        except Exception as e:
+            log.error(f"Failed to prefetch durations in '{folder}': {e}")
+
+
 def play_video(video_path, duration, label):
     try:
         ts = int(time.time())
         # caspar.overlay_caption(f"{label} - Timestamp: {ts}")
+        playback.arm()
         caspar.play_video(video_path)
+        prefetch_durations()
         time.sleep(PLAYER_SLEEP)
     except Exception as e:
         log.error(f"Playback failed for '{video_path}': {e}")
 
 
 def get_next_random_episode(count=5):
-    show_folders = [f for f in EPISODES_FOLDER.iterdir() if f.is_dir()]
+    # get_show_folders() hands back a fresh copy of the cached listing, so
+    # shuffling it leaves the cache untouched.
+    show_folders = get_show_folders()
     random.shuffle(show_folders)
 
     selected = []
     for folder in show_folders:
-        episode_candidates = [
-            f
-            for f in folder.iterdir()
-            if f.is_file()
-            and f.suffix.lower() in VIDEO_EXTENSIONS
-            and f.name != SLOT_VIDEO.name
-        ]
-        if not episode_candidates:
+        episodes = list_videos(folder)
+        if not episodes:
             continue
-        episode = random.choice(episode_candidates)
+        # Pick straight from the cached listing; the filtered copy is only
+        # built in the rare case that the slot clip itself was drawn.
+        episode = random.choice(episodes)
+        if episode.name in EXCLUDED_NAMES:
+            others = [f for f in episodes if f.name not in EXCLUDED_NAMES]
+            if not others:
+                continue
+            episode = random.choice(others)
         log.info(f"Adding {episode} to the queue")
-        selected.append(Path(episode))
+        selected.append(episode)
         if len(selected) >= count:
             break
 
@@ -204,49 +720,94 @@ def get_next_random_episode(count=5):
     return selected
 
 
+refill_lock = threading.Lock()
+
+
 def refill_queue():
-    while len(play_queue) < QUEUE_MAX_SIZE:
-        next_clip_list = get_next_random_episode()
-        for next_clip in next_clip_list:
-            if not next_clip or not next_clip.exists():
-                continue
-            duration = get_video_duration(next_clip)
-            if duration <= 1:
-                continue
-            play_queue.append(
-                {
-                    "path": normalize_path(next_clip),
-                    "type": (
-                        "EPISODE" if next_clip.parent == EPISODES_FOLDER else "FILLER"
-                    ),
-                    "label": next_clip.name,
-                    "duration": duration,
-                }
-            )
+    with refill_lock:
+        while len(play_queue) < QUEUE_MAX_SIZE:
+            next_clip_list = [
+                clip for clip in get_next_random_episode() if clip and clip.exists()
+            ]
+            durations = get_video_durations_bulk(next_clip_list)
+            # Counted rather than compared against len(play_queue), which the
+            # scheduler may popleft() from while a background refill runs.
+            added = 0
+            for next_clip, duration in zip(next_clip_list, durations):
+                if duration <= 1:
+                    continue
+                added += 1
+                play_queue.append(
+                    ClipItem(
+                        path=normalize_path(next_clip),
+                        type="EPISODE",
+                        label=next_clip.name,
+                        duration=duration,
+                    )
+                )
+            if not added:
+                log.warn("No playable episodes found while refilling the queue.")
+                break
 
 
-def get_random_filler():
-    fillers = [
-        f
-        for f in FILLER_FOLDER.iterdir()
-        if f.is_file()
-        and f.suffix.lower() in VIDEO_EXTENSIONS
-        and f not in recent_fillers
-    ]
-    if not fillers:
+def refill_queue_in_background():
+    # Tops up the queue while the current clip plays, so the listing and
+    # probing it needs overlap with playback instead of running between clips.
+    def run():
+        try:
+            refill_queue()
+        except Exception as e:
+            log.error(f"Background queue refill failed: {e}")
+
+    threading.Thread(target=run, daemon=True).start()
+
+
+def remember_filler(filler):
+    if len(recent_fillers) == recent_fillers.maxlen:
+        evicted = recent_fillers.popleft()
+        if evicted not in recent_fillers:
+            recent_fillers_set.discard(evicted)
+    recent_fillers.append(filler)
+    recent_fillers_set.add(filler)
+
+
+filler_index = (None, [], [])  # (listing it was built from, durations, fillers)
+
+
+def get_filler_index():
+    # Fillers sorted by duration, rebuilt only when the folder listing changes,
+    # so picking one that fits needs no probing on the hot path.
+    global filler_index
+    listing = list_videos(FILLER_FOLDER)
+    if filler_index[0] is not listing:
+        probed = zip(get_video_durations_bulk(listing), listing)
+        probed = sorted((p for p in probed if p[0] > 1), key=itemgetter(0))
+        filler_index = (
+            listing,
+            [duration for duration, _ in probed],
+            [filler for _, filler in probed],
+        )
+    return filler_index[1], filler_index[2]
+
+
+def get_random_filler(max_duration=None):
+    durations, all_fillers = get_filler_index()
+    if max_duration is not None:
+        all_fillers = all_fillers[: bisect_left(durations, max_duration)]
+    fillers = [f for f in all_fillers if f not in recent_fillers_set]
+    if not fillers and all_fillers:
+        # Every filler that fits was played recently; start the history over.
+        # Nothing fitting at all is left alone, so short gaps keep the history.
         recent_fillers.clear()
-        fillers = [
-            f
-            for f in FILLER_FOLDER.iterdir()
-            if f.is_file() and f.suffix.lower() in VIDEO_EXTENSIONS
-        ]
+        recent_fillers_set.clear()
+        fillers = all_fillers
     return random.choice(fillers) if fillers else None
 
 
 def play_filler_until_slot(seconds_remaining):
     try:
         while seconds_remaining > SLOT_DURATION:
-            filler = get_random_filler()
+            filler = get_random_filler(seconds_remaining - 2)
             if not filler or not filler.exists():
                 log.warn("No valid filler found.")
                 break
@@ -255,9 +816,11 @@ def play_filler_until_slot(seconds_remaining):
                 continue
             log.info(f"Playing filler: {filler.name} ({duration:.1f}s)")
             play_video(filler, duration, "FILLER")
-            recent_fillers.append(filler)
-            time.sleep(duration)
-            seconds_remaining -= duration
+            remember_filler(filler)
+            started = time.monotonic()
+            playback.wait(duration)
+            # Charge the time actually spent, which is less if we were woken.
+            seconds_remaining -= time.monotonic() - started
     except Exception as e:
         log.error(f"Filler playback failed: {e}")
 
@@ -267,75 +830,98 @@ def play_commercial_block(duration):
     play_filler_until_slot(duration)
 
 
+# (listings it was built from, durations, episodes, all episodes probed)
+episode_index = ((), [], [], False)
+
+
+def get_episode_index():
+    # Episodes sorted by duration, rebuilt only when a show folder's listing
+    # changes. Flat parallel lists keep the searches on plain float compares.
+    # Episodes not probed yet are left out and queued for the probe workers;
+    # the index stays marked incomplete and is rebuilt until they are in.
+    global episode_index
+    show_dirs = list_subdirs(EPISODES_FOLDER)
+    listings = tuple(list_videos(show) for show in show_dirs)
+    built_from, complete = episode_index[0], episode_index[3]
+    if (
+        not complete
+        or len(built_from) != len(listings)
+        or any(old is not new for old, new in zip(built_from, listings))
+    ):
+        # The library may have grown since the startup warm-up sized the cache
+        reserve_duration_cache(sum(map(len, listings)) + len(filler_index[0] or ()))
+        candidates = []
+        complete = True
+        for listing in listings:
+            for ep in listing:
+                if ep.name not in EXCLUDED_NAMES:
+                    duration = cached_duration(ep)
+                    if duration is None:
+                        complete = False
+                    elif duration > 1:
+                        candidates.append((duration, ep))
+        # Shuffle before the stable sort so equal durations land in random order.
+        random.shuffle(candidates)
+        candidates.sort(key=itemgetter(0))
+        episode_index = (
+            listings,
+            [duration for duration, _ in candidates],
+            [ep for _, ep in candidates],
+            complete,
+        )
+    return episode_index[1], episode_index[2]
+
+
 def get_fitting_episode(max_duration):
-    show_dirs = [d for d in EPISODES_FOLDER.iterdir() if d.is_dir()]
-    random.shuffle(show_dirs)
+    durations, episodes = get_episode_index()
 
+    # Try to find best single episode: the longest ones that still fit
     best_single = None
-    smallest_gap = max_duration
-
-    # Try to find best single episode
-    for show in show_dirs:
-        episodes = [
-            f
-            for f in show.iterdir()
-            if f.is_file()
-            and f.suffix.lower() in VIDEO_EXTENSIONS
-            and f.name != SLOT_VIDEO.name
+    fit_end = bisect_right(durations, max_duration)
+    if fit_end:
+        i = random.randrange(max(0, fit_end - FIT_CHOICES), fit_end)
+        duration, ep = durations[i], episodes[i]
+        best_single = [
+            ClipItem(
+                path=normalize_path(ep),
+                type="EPISODE",
+                label=f"{ep.parent.name} - {ep.name}",
+                duration=duration,
+            )
         ]
-        random.shuffle(episodes)
-        for ep in episodes:
-            duration = get_video_duration(ep)
-            if 1 < duration <= max_duration:
-                gap = max_duration - duration
-                if gap < smallest_gap:
-                    best_single = [
-                        {
-                            "path": normalize_path(ep),
-                            "type": "EPISODE",
-                            "label": f"{show.name} - {ep.name}",
-                            "duration": duration,
-                        }
-                    ]
-                    smallest_gap = gap
-
-    # Try to find best pair of episodes
-    all_eps = [
-        f
-        for d in show_dirs
-        for f in d.iterdir()
-        if f.is_file()
-        and f.suffix.lower() in VIDEO_EXTENSIONS
-        and f.name != SLOT_VIDEO.name
-    ]
-    random.shuffle(all_eps)
+
+    # Try to find best pair of episodes: two-pointer sweep over the sorted
+    # durations, recording the best partner for each shorter episode. Only the
+    # FIT_CHOICES closest pairs are kept, in a max-heap keyed on -gap, and the
+    # sweep stops once all of them are within FIT_TOLERANCE.
+    closest = []
+    lo, hi = 0, fit_end - 1
+    while lo < hi:
+        total = durations[lo] + durations[hi]
+        if total > max_duration:
+            hi -= 1
+            continue
+        pair = (total - max_duration, lo, hi)
+        if len(closest) < FIT_CHOICES:
+            heapq.heappush(closest, pair)
+        elif pair > closest[0]:
+            heapq.heapreplace(closest, pair)
+        if len(closest) == FIT_CHOICES and -closest[0][0] < FIT_TOLERANCE:
+            break
+        lo += 1
 
     best_pair = None
-    smallest_pair_gap = max_duration
-
-    for i in range(len(all_eps)):
-        for j in range(i + 1, len(all_eps)):
-            d1 = get_video_duration(all_eps[i])
-            d2 = get_video_duration(all_eps[j])
-            total = d1 + d2
-            if 2 < total <= max_duration:
-                gap = max_duration - total
-                if gap < smallest_pair_gap:
-                    best_pair = [
-                        {
-                            "path": normalize_path(all_eps[i]),
-                            "type": "EPISODE",
-                            "label": all_eps[i].name,
-                            "duration": d1,
-                        },
-                        {
-                            "path": normalize_path(all_eps[j]),
-                            "type": "EPISODE",
-                            "label": all_eps[j].name,
-                            "duration": d2,
-                        },
-                    ]
-                    smallest_pair_gap = gap
+    if closest:
+        _, i, j = random.choice(closest)
+        best_pair = [
+            ClipItem(
+                path=normalize_path(episodes[k]),
+                type="EPISODE",
+                label=episodes[k].name,
+                duration=durations[k],
+            )
+            for k in (i, j)
+        ]
 
     # If no pair or single episode fits, return a filler block
     if not best_pair and not best_single:
@@ -343,12 +929,12 @@ def get_fitting_episode(max_duration):
         if filler and filler.exists():
             duration = get_video_duration(filler)
             return [
-                {
-                    "path": normalize_path(filler),
-                    "type": "FILLER",
-                    "label": f"FALLBACK - {filler.name}",
-                    "duration": duration,
-                }
+                ClipItem(
+                    path=normalize_path(filler),
+                    type="FILLER",
+                    label=f"FALLBACK - {filler.name}",
+                    duration=duration,
+                )
             ]
         else:
             log.warn("No fallback filler available.")
@@ -366,20 +952,20 @@ def scheduler():
         log.info("Launching slot content")
         slot_clip = get_random_slot_ts()
         play_video(slot_clip, SLOT_DURATION, "SLOT")
-        time.sleep(SLOT_DURATION)
+        playback.wait(SLOT_DURATION)
         return now.hour
 
     def play_fallback_stack(seconds_to_slot):
         stack = get_random_episodes(count=5)
         for item in stack:
-            if not Path(item["path"]).exists():
-                log.warn(f"Skipping missing fallback: {item['label']}")
+            if not Path(item.path).exists():
+                log.warn(f"Skipping missing fallback: {item.label}")
                 continue
 
-            if item["duration"] < seconds_to_slot - SLOT_DURATION:
-                log.info(f"Fallback play: {item['label']} ({item['duration']:.1f}s)")
-                play_video(item["path"], item["duration"], item["type"])
-                time.sleep(item["duration"])
+            if item.duration < seconds_to_slot - SLOT_DURATION:
+                log.info(f"Fallback play: {item.label} ({item.duration:.1f}s)")
+                play_video(item.path, item.duration, item.type)
+                playback.wait(item.duration)
                 seconds_to_slot = time_until_next_slot()
 
                 if seconds_to_slot > SLOT_DURATION + COMMERCIAL_PADDING:
@@ -394,6 +980,10 @@ def scheduler():
     last_slot_hour = None
     log.info(f"Scheduler booting at {datetime.now()}")
 
+    videos = get_all_videos()
+    queued = warm_duration_cache(videos)
+    log.info(f"Duration cache: {queued} of {len(videos)} files queued for probing")
+
     startup_time = time.time()
     refill_queue()
     if time.time() - startup_time > 10:
@@ -405,7 +995,7 @@ def scheduler():
 
             if not EPISODES_FOLDER.exists():
                 log.warn("Episodes folder missing. Waiting...")
-                time.sleep(30)
+                sleep_until_woken(30)
                 continue
 
             seconds_to_slot = time_until_next_slot()
@@ -422,13 +1012,13 @@ def scheduler():
 
             if fitting_episodes:
                 for ep in fitting_episodes:
-                    if not Path(ep["path"]).exists():
-                        log.warn(f"Skipping missing file: {ep['label']}")
+                    if not Path(ep.path).exists():
+                        log.warn(f"Skipping missing file: {ep.label}")
                         continue
 
-                    log.info(f"Playing fitting: {ep['label']} ({ep['duration']:.1f}s)")
-                    play_video(ep["path"], ep["duration"], ep["type"])
-                    time.sleep(max(0, ep["duration"] - 2))
+                    log.info(f"Playing fitting: {ep.label} ({ep.duration:.1f}s)")
+                    play_video(ep.path, ep.duration, ep.type)
+                    playback.wait(ep.duration, early=2)
 
                 if is_slot_time(datetime.now(), last_slot_hour):
                     last_slot_hour = execute_slot(datetime.now())
@@ -443,38 +1033,39 @@ def scheduler():
             if not play_queue:
                 refill_queue()
 
-            current_item = play_queue.pop(0) if play_queue else None
+            current_item = play_queue.popleft() if play_queue else None
             if not current_item:
                 log.warn("No item in queue. Waiting briefly...")
-                time.sleep(5)
+                sleep_until_woken(5)
                 continue
 
-            if not Path(current_item["path"]).exists():
+            if not Path(current_item.path).exists():
                 log.warn("Skipping missing queued item")
                 continue
 
-            if current_item["duration"] >= seconds_to_slot - SLOT_DURATION:
+            if current_item.duration >= seconds_to_slot - SLOT_DURATION:
                 log.info("Item too close to slot. Playing filler.")
                 play_filler_until_slot(seconds_to_slot - SLOT_DURATION)
                 last_slot_hour = execute_slot(datetime.now())
                 refill_queue()
                 continue
 
-            log.info(f"Playing queued item: {current_item['label']}")
+            log.info(f"Playing queued item: {current_item.label}")
             play_video(
-                current_item["path"], current_item["duration"], current_item["type"]
+                current_item.path, current_item.duration, current_item.type
             )
-            time.sleep(max(0, current_item["duration"] - 2))
+            refill_queue_in_background()
+            playback.wait(current_item.duration, early=2)
 
             seconds_to_slot = time_until_next_slot()
             if (
                 play_queue
-                and play_queue[0]["duration"] < seconds_to_slot - SLOT_DURATION
+                and play_queue[0].duration < seconds_to_slot - SLOT_DURATION
             ):
-                next_item = play_queue.pop(0)
-                log.info(f"Playing next in queue: {next_item['label']}")
-                play_video(next_item["path"], next_item["duration"], next_item["type"])
-                time.sleep(next_item["duration"])
+                next_item = play_queue.popleft()
+                log.info(f"Playing next in queue: {next_item.label}")
+                play_video(next_item.path, next_item.duration, next_item.type)
+                playback.wait(next_item.duration)
                 refill_queue()
             else:
                 log.info("Slot too close. Holding next queued item.")
@@ -491,14 +1082,27 @@ def scheduler():
 
         except Exception as loop_error:
             log.error(f"Scheduler loop exception: {loop_error}")
-            time.sleep(10)
+            sleep_until_woken(10)
 
 
 if __name__ == "__main__":
     log.info("Project Aries - Hourglass")
     log.info("Maintained by Physics Prop")
     caspar = CasparCGClient()
+    atexit.register(caspar.close)
+    playback = PlaybackMonitor()
+    if hasattr(signal, "SIGUSR1"):  # not available on Windows
+        # Event.set() takes a lock the interrupted frame may already hold
+        # (inside wake.clear()), so set it from another thread.
+        signal.signal(
+            signal.SIGUSR1,
+            lambda signum, frame: threading.Thread(target=wake.set, daemon=True).start(),
+        )
+    playback.start()
+    start_probe_workers()
     SLOT_VIDEO = get_random_slot_ts()
+    if SLOT_VIDEO:
+        EXCLUDED_NAMES = frozenset({SLOT_VIDEO.name})
     try:
         scheduler()
     except KeyboardInterrupt: